@@ -1,18 +1,28 @@
 import os
-import shutil
+import sys
 import time
+import queue
 import threading
-import subprocess
+from typing import ClassVar
+from urllib.parse import parse_qs, urlparse
 
 import pygame as pg
 from pygame.typing import Point
 import av
 from av.audio.resampler import AudioResampler
+from av.codec.hwaccel import HWAccel, hwdevices_available
+from av.video.reformatter import VideoReformatter
 import sounddevice as sd
 import numpy as np
 
 
 class VideoPlayer:
+    # direct media URLs already resolved by yt-dlp, shared by every player,
+    # with the time.time() they stop being valid at
+    _resolved_sources: ClassVar[dict[str, tuple[str, float]]] = {}
+    # how long a lookup is kept when the URL carries no expiry of its own
+    _resolve_ttl: ClassVar[float] = 300.0
+
     def __init__(
         self,
         source: str,
@@ -28,16 +38,17 @@ class VideoPlayer:
         channel_layout: str = "stereo",
         audio_codec: str = "aac",
         play_audio: bool = True,
+        hardware_decoding: bool = True,
     ) -> None:
         """
         The constructor for the VideoPlayer class.
 
         Params:
-            - source: str | bytes. A file path or a URL. Raises FileNotFoundError if source is a non-existent file path. If `source` is a URL, then it can either be a direct video URL, or a URL for a media site like `youtube.com`. If so, the program `ffmpeg` would need to be installed and available on PATH.
+            - source: str | bytes. A file path or a URL. Raises FileNotFoundError if source is a non-existent file path. If `source` is a URL, then it can either be a direct video URL, or a URL for a media site like `youtube.com`.
 
             - speed: float. The playback speed for the video. Defaults to 1.
 
-            - frame_rate: int | None. The default frame rate of the video. Defaults to 30 FPS.
+            - frame_rate: int | None. The default frame rate of the video, used when the stream does not report one. Defaults to 30 FPS.
 
             - video_size: tuple[int, int]. The default size of the video in pixels. Defaults to `640x480`.
 
@@ -58,6 +69,8 @@ class VideoPlayer:
             - audio_codec: str. The audio codec to use. Defaults to `aac`.
 
             - play_audio: bool. Whether or not the audio will play. Defaults to `True`.
+
+            - hardware_decoding: bool. Whether or not to decode the video on the GPU when a supported device is available. Falls back to software decoding otherwise. Defaults to `True`.
         """
         self._source = self._parse_source(source)
         self._speed = max(0.1, min(8.0, speed))
@@ -74,6 +87,7 @@ class VideoPlayer:
         self._channel_layout = channel_layout
         self._audio_codec = audio_codec
         self._play_audio = play_audio
+        self._hardware_decoding = hardware_decoding
 
         self._audio_opts = {
             "sample_rate": str(self._frequency),
@@ -88,59 +102,126 @@ class VideoPlayer:
             "codec": self._video_codec,
         }
 
-        if self._play_audio:
-            self._audio_container = av.open(self._source, options=self._audio_opts)
-            self._audio_stream = self._audio_container.streams.audio
-        else:
-            self._audio_container = None
-            self._audio_stream = None
+        # one container is demuxed for both threads, so the source is only
+        # opened, probed and read once
+        self._container = self._open_container()
+        self._video_stream = self._container.streams.video[0]
 
-        if self._audio_stream and self._play_audio:
-            self._audio_stream = self._audio_stream[0]
+        if self._play_audio and self._container.streams.audio:
+            self._audio_stream = self._container.streams.audio[0]
             self._stream = sd.OutputStream(
                 samplerate=self._frequency,
                 channels=self._audio_stream.channels,
-                dtype=np.float32,
+                dtype=np.int16,
+                callback=self._audio_callback,
             )
-            self._resampler = AudioResampler(
-                "fltp", self._audio_stream.layout.name, self._frequency
+            # packed samples come out already interleaved as (samples, channels).
+            # the resampler is rebuilt by the audio thread when the speed changes
+            self._resampler = None
+            self._resampler_speed = None
+
+            # half a second of resampled audio between the decoder and the
+            # output callback. the read/write counters only ever grow, the
+            # callback advances `_buffer_read` and the audio thread `_buffer_write`
+            self._audio_buffer = np.zeros(
+                (self._frequency // 2, self._audio_stream.channels), np.int16
             )
+            self._buffer_read = 0
+            self._buffer_write = 0
+            # (seek serial, media time) at the end of the buffered samples
+            self._buffer_end = (0, 0.0)
+            self._flush_audio = False
+            # set by the callback whenever it frees space in the ring
+            self._buffer_event = threading.Event()
 
             self._has_audio = True
         else:
+            self._audio_stream = None
             self._has_audio = False
 
-        self._video_container = av.open(self._source, options=self._video_opts)
-        self._video_stream = self._video_container.streams.video[0]
-
-        self._fps = float(self._video_stream.average_rate)
-        self._duration = float(
-            self._video_stream.duration * self._video_stream.time_base
-        )
+        # decode several frames at once as well as slices within a frame.
+        # libavcodec picks the thread count and releases the GIL while it works
+        self._video_stream.thread_type = "AUTO"
+        self._reformatter = VideoReformatter()
+
+        # variable frame rate and raw streams can report no average rate
+        rate = self._video_stream.average_rate or self._video_stream.guessed_rate
+        if rate:
+            self._fps = float(rate)
+        # matroska, webm and live streams often only report a container duration
+        if self._video_stream.duration is not None:
+            self._duration = float(
+                self._video_stream.duration * self._video_stream.time_base
+            )
+        elif self._container.duration is not None:
+            self._duration = self._container.duration / av.time_base
+        else:
+            self._duration = 0.0
 
         self._w = self._video_stream.width
         self._h = self._video_stream.height
         self._size = (self._w, self._h)
 
-        self._audio_loop_count = 0
-        self._video_loop_count = 0
+        self._loop_count = 0
+        # media time covered by one pass through the file, set at its end
+        self._pass_length = 0.0
 
         self._paused = False
         self._stopped = False
-
-        self._frame = pg.Surface((self._w, self._h))
-
+        self._resync = False
+        # media time the last seek aimed for. frames before it are only
+        # decoded to get there and are never converted or shown
+        self._seek_target = 0.0
+
+        # single-producer ring of preallocated frames; `_frame_idx` is the
+        # latest published slot and is only ever advanced by the video thread
+        self._frames = [pg.Surface(self._size) for _ in range(4)]
+        self._frame_idx = 0
+        self._frame_format = self._surface_format(self._frames[0])
+
+        # destination for get_frame's scaling, reallocated only on resize, and
+        # the frame it currently holds so each frame is only scaled once
+        self._scaled = None
+        self._scaled_size = None
+        self._scaled_idx = None
+        self._smooth_scale = False
+
+        # packets read by the demux thread, tagged with the seek serial they
+        # were read under. `None` in place of a packet marks the end of a pass
+        self._video_packets = queue.Queue()
+        self._audio_packets = queue.Queue()
+        # set whenever a packet is taken, a seek is requested or on stop
+        self._demux_event = threading.Event()
+
+        # seeks are done by the demux thread, which holds both locks so it never
+        # flushes a decoder while it's in use. the serial goes up on every seek
+        self._seek_request = None
+        self._serial = 0
+        self._video_lock = threading.Lock()
+        self._audio_lock = threading.Lock()
+
+        self._demux_thread = None
         self._audio_thread = None
         self._video_thread = None
+        # the audio and video threads meet here once each has its first data
+        # decoded, so neither clock starts ahead of the other
+        self._start_barrier = threading.Barrier(2 if self._has_audio else 1)
 
         self._pause_event = threading.Event()
         self._pause_event.set()
 
-        self._frame_lock = threading.Lock()
-
-        self._time_lock = threading.Lock()
+        # current playback position in seconds. single reads and writes are
+        # atomic under the GIL, so the threads share it without a lock
         self._time = 0.0
         self._idx = 0
+        # (seek serial, media time) of the audio the device is playing. media
+        # time keeps counting up across loops
+        self._clock = (0, 0.0)
+        # when the device last took samples or the clock moved to a seek, so
+        # the clock can be carried on after the audio of a pass runs out
+        self._clock_time = 0.0
+        # whether the audio thread has reached the end of the current pass
+        self._audio_done = False
 
     @property
     def source(self) -> str:
@@ -246,6 +327,13 @@ class VideoPlayer:
         """
         return self._play_audio
 
+    @property
+    def hardware_decoding(self) -> bool:
+        """
+        Whether or not the video is decoded on the GPU when possible (read-only).
+        """
+        return self._hardware_decoding
+
     @property
     def has_audio(self) -> bool:
         """
@@ -278,115 +366,554 @@ class VideoPlayer:
         if os.path.exists(source):
             return source
 
+        now = time.time()
+        cached = self._resolved_sources.get(source)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        # importing yt-dlp is slow, so it's only done for sources that need it
+        import yt_dlp
+
+        options = {
+            "quiet": True,
+            "no_warnings": True,
+            "noplaylist": True,
+            # a single format with both audio and video, as one URL is opened
+            "format": "best",
+        }
         try:
-            subprocess.run(
-                ["yt-dlp", "--skip-download", "--quiet", source],
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-            )
-            is_special = True
-        except subprocess.CalledProcessError:
-            is_special = False
-
-        if is_special:
-            if not shutil.which("ffmpeg"):
-                print("FFmpeg must be installed. https://ffmpeg.com")
-                raise SystemExit
-
-            process = subprocess.run(
-                ["yt-dlp", "--quiet", "-g", source],
-                capture_output=True,
-                text=True,
-                check=True,
-            )
-            return process.stdout
-        else:
+            with yt_dlp.YoutubeDL(options) as ydl:
+                info = ydl.extract_info(source, download=False)
+        except yt_dlp.utils.DownloadError:
+            # not a site yt-dlp knows, so it's opened as a direct URL. that is
+            # remembered too, so the lookup isn't repeated for every player
+            self._resolved_sources[source] = (source, now + self._resolve_ttl)
             return source
 
-    def _audio_process(self) -> None:
-        self._stream.start()
+        url = info.get("url", source)
+
+        # signed media URLs stop working after a while, and most say when in
+        # an `expire` query parameter. a minute is left for opening the stream
+        expires = now + self._resolve_ttl
+        expire = parse_qs(urlparse(url).query).get("expire")
+        if expire and expire[0].isdigit():
+            expires = min(expires, int(expire[0]) - 60)
+
+        self._resolved_sources[source] = (url, expires)
+        return url
+
+    def _open_container(self) -> av.container.InputContainer:
+        """
+        Open the container, decoding the video on the GPU if a supported device is available.
+        """
+        # the options only matter to raw demuxers, which have a single stream
+        options = {**self._audio_opts, **self._video_opts}
+
+        if self._hardware_decoding:
+            available = hwdevices_available()
+            for device in ("cuda", "vaapi", "videotoolbox", "d3d11va", "dxva2"):
+                if device not in available:
+                    continue
+
+                try:
+                    return av.open(
+                        self._source,
+                        options=options,
+                        hwaccel=HWAccel(device, allow_software_fallback=True),
+                    )
+                except av.FFmpegError:
+                    # the device type is built in but there is no usable hardware
+                    continue
+
+        return av.open(self._source, options=options)
+
+    def _audio_callback(self, outdata: np.ndarray, frames: int, *_) -> None:
+        """
+        Fill the output device's buffer from the audio ring buffer.
+        """
+        if self._flush_audio:
+            self._buffer_read = self._buffer_write
+            self._flush_audio = False
+
+        size = len(self._audio_buffer)
+        n = 0
+        if self._pause_event.is_set():
+            n = min(frames, self._buffer_write - self._buffer_read)
+
+        start = self._buffer_read % size
+        first = min(n, size - start)
+        outdata[:first] = self._audio_buffer[start : start + first]
+        outdata[first:n] = self._audio_buffer[: n - first]
+        outdata[n:] = 0
+
+        if self._volume != 1:
+            np.multiply(outdata, self._volume, out=outdata, casting="unsafe")
+
+        self._buffer_read += n
+        self._buffer_event.set()
+
+        # the clock follows what the device is playing, not what was decoded
+        serial, end_time = self._buffer_end
+        if n or serial != self._clock[0]:
+            self._clock_time = time.monotonic()
+
+        buffered = self._buffer_write - self._buffer_read
+        self._clock = (serial, end_time - buffered * self._speed / self._frequency)
+
+    def _buffer_audio(self, data: np.ndarray, pts: float, serial: int) -> None:
+        """
+        Copy samples into the audio ring buffer, waiting for the output callback to make room.
+        """
+        size = len(self._audio_buffer)
+        written = 0
+        while written < len(data) and not self._stopped and serial == self._serial:
+            free = size - (self._buffer_write - self._buffer_read)
+            if not free:
+                self._buffer_event.wait()
+                self._buffer_event.clear()
+                continue
+
+            n = min(free, len(data) - written)
+            start = self._buffer_write % size
+            first = min(n, size - start)
+            self._audio_buffer[start : start + first] = data[written : written + first]
+            self._audio_buffer[: n - first] = data[written + first : written + n]
+
+            written += n
+            self._buffer_end = (serial, pts + written * self._speed / self._frequency)
+            self._buffer_write += n
+
+    def _wait_for_start(self) -> None:
+        """
+        Wait until the audio and video threads both have their first data decoded.
+        """
+        try:
+            self._start_barrier.wait()
+        except threading.BrokenBarrierError:
+            # stop() was called before playback began
+            pass
+
+    def _demux_process(self) -> None:
+        """
+        Read packets from the container and hand them to the audio and video threads in a loop
+        """
+        queues = {self._video_stream.index: self._video_packets}
+        if self._has_audio:
+            queues[self._audio_stream.index] = self._audio_packets
+
+        streams = [self._container.streams[i] for i in queues]
+        time_bases = {i: float(self._container.streams[i].time_base) for i in queues}
+
+        start = 0.0
+        if self._container.start_time is not None:
+            start = self._container.start_time / av.time_base
+        # where the packets read in this pass end, to measure its length by
+        end = start
 
         while not self._stopped:
-            for frame in self._audio_container.decode(audio=0):
-                if self._stopped:
+            for packet in self._container.demux(streams):
+                if self._stopped or self._seek_request is not None:
                     break
 
-                self._pause_event.wait()
+                # the empty packets that end demux() only set `stream`
+                index = packet.stream.index
+                if packet.pts is not None:
+                    time_base = time_bases[index]
+                    end = max(end, (packet.pts + packet.duration) * time_base)
+
+                queues[index].put((self._serial, packet))
+
+                # read ahead until every thread has a few dozen packets queued.
+                # a thread that runs dry is never kept waiting on the others
+                self._demux_event.clear()
+                while (
+                    not self._stopped
+                    and self._seek_request is None
+                    and all(q.qsize() >= 32 for q in queues.values())
+                ):
+                    self._demux_event.wait()
+                    self._demux_event.clear()
+            else:
+                # the last packets from demux() drain the decoders
+                self._loop_count += 1
+                self._pass_length = end - start
+
+                for q in queues.values():
+                    q.put((self._serial, None))
+
+                # seeking flushes the decoders, so they have to finish draining
+                # first. after the last pass only a seek can restart reading
+                last = self._loop and self._loop_count >= self._loop
+                self._demux_event.clear()
+                while (
+                    not self._stopped
+                    and self._seek_request is None
+                    and (last or not all(q.empty() for q in queues.values()))
+                ):
+                    self._demux_event.wait()
+                    self._demux_event.clear()
+
+                if self._seek_request is None and not self._stopped:
+                    with self._audio_lock, self._video_lock:
+                        self._container.seek(0)
+
+                    end = start
+                    continue
+
+            if self._seek_request is not None and not self._stopped:
+                self._seek_container(list(queues.values()))
+
+    def _seek_container(self, queues: list[queue.Queue]) -> None:
+        """
+        Seek the container to the requested time and throw away everything read before it.
+        """
+        timestamp = self._seek_request
+        with self._audio_lock, self._video_lock:
+            self._seek_request = None
+            self._container.seek(
+                int(timestamp / self._video_stream.time_base),
+                stream=self._video_stream,
+            )
+
+            for q in queues:
+                while True:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+
+            self._serial += 1
 
-                with self._time_lock:
-                    self._idx = frame.pts
-                    self._time = frame.pts * float(frame.time_base)
+    def _audio_process(self) -> None:
+        """
+        Decode audio packets and feed the samples to the output callback in a loop
+        """
+        codec_context = self._audio_stream.codec_context
+        time_base = float(self._audio_stream.time_base)
+        serial = 0
+        offset = 0.0
+        target = 0.0
+        started = False
 
-                frame = self._resampler.resample(frame)[0]
-                data = frame.to_ndarray().astype(np.float32)
-                data = np.transpose(data)
-                data *= self._volume
-                data = np.ascontiguousarray(data)
+        while not self._stopped:
+            packet_serial, packet = self._audio_packets.get()
+            self._demux_event.set()
+
+            if self._stopped:
+                break
+
+            if packet is None:
+                # a stream without any samples still has to release the video
+                if not started:
+                    self._wait_for_start()
+                    # the callback only stamps the clock when it plays something
+                    self._clock_time = time.monotonic()
+                    self._stream.start()
+                    started = True
+
+                # the video thread ends playback once this has played out
+                self._audio_done = True
+                if self._loop and self._loop_count >= self._loop:
+                    continue
 
-                if self._speed != 1:
-                    indices = np.arange(0, len(data), self._speed).astype(int)
-                    indices = indices[indices < len(data)]
+                # the next pass is played after this one, not over it
+                offset += self._pass_length
+                target = 0.0
+                continue
 
-                    data = data[indices]
+            self._audio_done = False
 
-                if self._stream.closed or self._stopped or not self._stream.active:
+            if packet_serial != serial:
+                # first packet after a seek. drop the audio still buffered from
+                # before it and start the clock at the new position
+                serial = packet_serial
+                target = self._seek_target
+                self._resampler_speed = None
+
+                # before the stream starts there is nothing to flush, and no
+                # callback running to do it
+                self._flush_audio = started
+                while self._flush_audio and not self._stopped:
+                    self._buffer_event.wait()
+                    self._buffer_event.clear()
+
+                self._buffer_end = (serial, offset + target)
+
+            with self._audio_lock:
+                if packet_serial != self._serial:
+                    continue
+
+                frames = codec_context.decode(packet)
+
+            for frame in frames:
+                self._pause_event.wait()
+
+                if self._stopped or serial != self._serial:
                     break
 
-                self._stream.write(data)
+                pts = frame.pts * time_base
+                if pts < target:
+                    continue
+
+                pts += offset
+
+                speed = self._speed
+                if speed != self._resampler_speed:
+                    # the speed is changed by resampling to `frequency / speed`
+                    # and playing that back at `frequency`, which libswresample
+                    # low-pass filters instead of just dropping samples
+                    self._resampler = AudioResampler(
+                        "s16",
+                        self._audio_stream.layout.name,
+                        round(self._frequency / speed),
+                    )
+                    self._resampler_speed = speed
+
+                # the resampler can hold samples back or release several frames
+                for resampled in self._resampler.resample(frame):
+                    data = resampled.to_ndarray().reshape(
+                        -1, resampled.layout.nb_channels
+                    )
+                    self._buffer_audio(data, pts, serial)
+                    pts += len(data) * speed / self._frequency
+
+                    if not started:
+                        self._wait_for_start()
+                        self._stream.start()
+                        started = True
+
+    def _surface_format(self, surface: pg.Surface) -> str | None:
+        """
+        The FFmpeg pixel format whose 32-bit pixels match the layout of `surface`, if any.
+        """
+        if surface.get_bytesize() != 4 or surface.get_masks()[3]:
+            return None
+
+        little = sys.byteorder == "little"
+        masks = surface.get_masks()[:3]
+        if masks == (0xFF0000, 0xFF00, 0xFF):
+            return "bgr0" if little else "0rgb"
+        if masks == (0xFF, 0xFF00, 0xFF0000):
+            return "rgb0" if little else "0bgr"
+
+        return None
+
+    def _update_surface(self, frame: av.VideoFrame, surface: pg.Surface) -> None:
+        """
+        Convert a decoded frame into the pixels of `surface`.
+        """
+        if self._frame_format:
+            # swscale writes the surface's own pixel layout, so the copy
+            # below is a plain (strided) memory copy
+            plane = self._reformatter.reformat(frame, format=self._frame_format).planes[
+                0
+            ]
+            pixels = np.frombuffer(plane, np.uint32).reshape(self._h, -1)
+            view = pg.surfarray.pixels2d(surface)
+            view[...] = pixels[:, : self._w].T
+            del view
+            return
+
+        # frombuffer shares the decoded pixels instead of copying them. passing
+        # the plane's line size keeps that true for frames with padded rows
+        plane = self._reformatter.reformat(frame, format="rgb24").planes[0]
+        pixels = pg.image.frombuffer(plane, self._size, "RGB", pitch=plane.line_size)
+        surface.blit(pixels, (0, 0))
 
-            self._audio_loop_count += 1
-            if self._audio_loop_count < self._loop or self._loop == 0:
-                self._audio_container.seek(0)
+    def _skip_to_keyframe(self, target: float, serial: int) -> bool:
+        """
+        Drop the queued video packets before the first keyframe at or after `target`, if it has been read yet.
+        """
+        time_base = float(self._video_stream.time_base)
+
+        # the lock keeps a seek from emptying the queue under us
+        with self._video_lock:
+            if serial != self._serial:
+                return False
+
+            with self._video_packets.mutex:
+                packets = list(self._video_packets.queue)
+
+            for n, (packet_serial, packet) in enumerate(packets):
+                if packet is None or packet_serial != serial:
+                    return False
+
+                if (
+                    packet.is_keyframe
+                    and packet.pts is not None
+                    and packet.pts * time_base >= target
+                ):
+                    break
             else:
-                self.stop()
+                return False
+
+            for _ in range(n):
+                self._video_packets.get_nowait()
+
+            # the frames still inside the decoder come from before the keyframe
+            self._video_stream.codec_context.flush_buffers()
+
+        self._demux_event.set()
+        return True
 
     def _video_process(self) -> None:
         """
-        Extract video frames and turn them into pygame Surfaces in a loop
-        """
+        Decode video packets and turn them into pygame Surfaces in a loop
+        """
+        audio_clock = self._has_audio
+        codec_context = self._video_stream.codec_context
+        # plain floats, so no Fraction is built for every frame
+        time_base = float(self._video_stream.time_base)
+        frame_interval = 1 / self._fps
+        frames = self._frames
+        clock_start = clock_speed = 0.0
+        serial = 0
+        # frames of every pass are timed after the previous pass, so neither
+        # clock has to jump back when the video loops
+        offset = 0.0
+        target = 0.0
+        skip_frame = "DEFAULT"
+        started = False
+        # whether the audio of this pass has played out with video still left
+        audio_ended = False
+        self._resync = True
+
         while not self._stopped:
-            last_time = 0
-            for i in self._video_container.decode(video=0):
+            packet_serial, packet = self._video_packets.get()
+            self._demux_event.set()
+
+            if self._stopped:
+                break
+
+            if packet is None:
+                if self._loop and self._loop_count >= self._loop:
+                    # the audio can end after the video, so playback only stops
+                    # once it has played out too
+                    while (
+                        audio_clock
+                        and not self._stopped
+                        and serial == self._serial
+                        and not self._audio_played_out(serial)
+                    ):
+                        time.sleep(0.01)
+
+                    if not self._stopped and serial == self._serial:
+                        self.stop()
+
+                    continue
+
+                offset += self._pass_length
+                target = 0.0
+                audio_ended = False
+                continue
+
+            if packet_serial != serial:
+                serial = packet_serial
+                target = self._seek_target
+                audio_ended = False
+                self._resync = True
+
+            with self._video_lock:
+                if packet_serial != self._serial:
+                    continue
+
+                decoded = codec_context.decode(packet)
+
+            for i in decoded:
                 self._pause_event.wait()
 
-                if self._stopped:
+                if self._stopped or serial != self._serial:
                     break
 
-                with self._time_lock:
-                    audio_pts = self._time
+                # seconds from the start of the file
+                pts = i.pts * time_base
+                speed = self._speed
 
-                pts = float(i.pts * i.time_base) / self._speed
-                delay = pts - audio_pts
+                # non-reference frames can't be needed to reach a seek target,
+                # and above double speed most frames are dropped anyway, so the
+                # decoder skips them instead of decoding them to throw away
+                skip = "NONREF" if pts < target or speed > 2 else "DEFAULT"
+                if skip != skip_frame:
+                    codec_context.skip_frame = skip
+                    skip_frame = skip
 
-                if delay > 0.005:
-                    time.sleep(min(delay, 0.005))
-                elif delay < -0.005:
-                    # frame is too late so drop it
+                if pts < target:
                     continue
 
-                if pts - last_time < 1 / (self._fps * self._speed):
-                    continue
+                # seconds of media time, which both clocks count in
+                media = pts + offset
+
+                if not started:
+                    self._wait_for_start()
+                    started = True
+
+                wall_clock = not audio_clock or audio_ended
+                if wall_clock and (self._resync or speed != clock_speed):
+                    # without audio the video is its own clock, anchored to the
+                    # wall clock again after every seek, resume or speed change
+                    clock_start = time.monotonic() - media / speed
+                    clock_speed = speed
+                    self._resync = False
+
+                while not self._stopped and serial == self._serial:
+                    if not wall_clock and self._audio_played_out(serial):
+                        # the audio of this pass is shorter than the video, and
+                        # its clock has stopped. the rest of the pass is timed
+                        # by the wall clock, from where the audio ended
+                        audio_ended = wall_clock = True
+                        clock_start = self._clock_time - self._clock[1] / speed
+                        clock_speed = speed
+                        self._resync = False
+
+                    if not wall_clock:
+                        clock_serial, clock = self._clock
+                        # until audio from after a seek reaches the device the
+                        # clock still shows the old position
+                        if clock_serial == serial:
+                            delay = (media - clock) / speed
+                        else:
+                            delay = 0.01
+                    else:
+                        delay = clock_start + media / speed - time.monotonic()
+
+                    if delay <= 0:
+                        break
+
+                    # the audio clock can jump on seeks, so the wait is capped
+                    # and the deadline checked again
+                    time.sleep(min(delay, 0.1))
+
+                if self._stopped or serial != self._serial:
+                    break
 
-                if not self.has_audio or not self.play_audio:
-                    with self._time_lock:
-                        self._time = pts
-                        self._idx = i.pts
+                if delay < -0.5:
+                    # far behind the clock, so jump to the next keyframe past it
+                    # if it has been read already, and skip every frame before
+                    # that point rather than decoding it only to drop it
+                    target = pts - delay * speed + 0.25
+                    if self._skip_to_keyframe(target, serial):
+                        break
 
-                frame = i.to_ndarray(format="rgb24")
-                frame = np.transpose(frame, (1, 0, 2))
-                frame = pg.surfarray.make_surface(frame)
+                if delay < -frame_interval / speed:
+                    # frame is too late so drop it
+                    continue
 
-                with self._frame_lock:
-                    self._frame = frame
+                self._time = pts
+                self._idx = i.pts
 
-                time.sleep(1 / self._fps)
+                back = frames[(self._frame_idx + 1) % len(frames)]
+                self._update_surface(i, back)
+                self._frame_idx += 1
 
-            self._video_loop_count += 1
-            if self._video_loop_count < self._loop or self._loop == 0:
-                self._video_container.seek(0)
-            else:
-                self.stop()
+    def _audio_played_out(self, serial: int) -> bool:
+        """
+        Whether the device has played all the audio of the current pass.
+        """
+        return (
+            self._audio_done
+            and self._buffer_read >= self._buffer_write
+            and self._clock[0] == serial
+        )
 
     def get_frame(self, size: Point = None) -> pg.Surface:
         """
@@ -395,16 +922,43 @@ class VideoPlayer:
         Params:
             - size: Point. The size of the surface to return. If `None`, the size will be the default size of the video frame. Defaults to `None`.
         """
-        with self._frame_lock:
-            if size and self._size != size:
-                self._frame = pg.transform.scale(self._frame, size)
+        frame_idx = self._frame_idx
+        frame = self._frames[frame_idx % len(self._frames)]
+        if size and self._size != tuple(size):
+            size = tuple(size)
+            if self._scaled_size != size:
+                self._scaled = pg.Surface(size, 0, frame)
+                self._scaled_size = size
+                self._scaled_idx = None
+
+                # nearest neighbour only looks right when every pixel becomes a
+                # whole block of pixels. smoothscale needs 24 or 32-bit surfaces
+                whole = size[0] % self._w == 0 and size[1] % self._h == 0
+                self._smooth_scale = not whole and frame.get_bitsize() in (24, 32)
 
-            return self._frame
+            if self._scaled_idx != frame_idx:
+                if self._smooth_scale:
+                    pg.transform.smoothscale(frame, size, self._scaled)
+                else:
+                    pg.transform.scale(frame, size, self._scaled)
+
+                self._scaled_idx = frame_idx
+
+            return self._scaled
+
+        return frame
 
     def start(self) -> None:
         """
         Starts playing the video and audio.
         """
+        if pg.display.get_surface():
+            # frames in the display's pixel format blit without conversion
+            self._frames = [i.convert() for i in self._frames]
+            self._frame_format = self._surface_format(self._frames[0])
+
+        self._demux_thread = threading.Thread(target=self._demux_process, daemon=True)
+
         if self._has_audio and self._play_audio:
             self._audio_thread = threading.Thread(
                 target=self._audio_process, daemon=True
@@ -412,11 +966,23 @@ class VideoPlayer:
 
         self._video_thread = threading.Thread(target=self._video_process, daemon=True)
 
+        self._demux_thread.start()
+
         if self._has_audio and self._play_audio:
             self._audio_thread.start()
 
         self._video_thread.start()
 
+    def _seek(self, _time: float, idx: int) -> None:
+        """
+        Ask the demux thread to move the playback to `_time` seconds.
+        """
+        self._time = _time
+        self._idx = idx
+        self._seek_target = float(_time)
+        self._seek_request = float(_time)
+        self._demux_event.set()
+
     def move(self, timestamp: float) -> None:
         """
         Move the audio and video to the given timestamp.
@@ -431,14 +997,7 @@ class VideoPlayer:
         if was_playing:
             self.toggle_pause()
 
-        if self._play_audio and self._has_audio:
-            self._audio_container.seek(idx, stream=self._audio_stream)
-
-        self._video_container.seek(idx, stream=self._video_stream)
-
-        with self._time_lock:
-            self._time = _time
-            self._idx = idx
+        self._seek(_time, idx)
 
         if was_playing:
             self.toggle_pause()
@@ -450,8 +1009,7 @@ class VideoPlayer:
         Params:
             - seconds: float. The number of seconds to forward by.
         """
-        with self._time_lock:
-            current_time = self._time
+        current_time = self._time
 
         self.move(current_time + seconds)
 
@@ -462,8 +1020,7 @@ class VideoPlayer:
         Params:
             - seconds: float. The number of seconds to rewind by.
         """
-        with self._time_lock:
-            current_time = self._time
+        current_time = self._time
         self.move(current_time - seconds)
 
     def move_frame(self, frame_number: int) -> None:
@@ -476,23 +1033,7 @@ class VideoPlayer:
 
         # TODO: Forwarding frames desyncs audio and video. Fix it.
 
-        idx = min(self._duration * self._video_stream.time_base, max(0, frame_number))
-        _time = idx / self._video_stream.time_base
-
-        if not self.paused:
-            self.toggle_pause()
-
-        if self._play_audio and self._has_audio:
-            self._audio_container.seek(idx, stream=self._audio_stream)
-
-        self._video_container.seek(idx, stream=self._video_stream)
-
-        with self._time_lock:
-            self._time = _time
-            self._idx = idx
-
-        if self.paused:
-            self.toggle_pause()
+        self.move(max(0, frame_number) / self._fps)
 
     def forward_frame(self, frames: int) -> None:
         """
@@ -501,8 +1042,8 @@ class VideoPlayer:
         Params:
             - frames: int. The number of frames to forward by.
         """
-        with self._time_lock:
-            current_frame = self._idx
+        # `_idx` is a timestamp in the stream's time base, not a frame number
+        current_frame = round(self._time * self._fps)
 
         self.move_frame(current_frame + frames)
 
@@ -513,10 +1054,10 @@ class VideoPlayer:
         Params:
             - frames: int. The number of frames to rewind by.
         """
-        with self._time_lock:
-            current_frame = self._idx
+        # `_idx` is a timestamp in the stream's time base, not a frame number
+        current_frame = round(self._time * self._fps)
 
-        self.move_frame(current_frane - frames)
+        self.move_frame(current_frame - frames)
 
     def set_volume(self, volume: float) -> None:
         """
@@ -578,6 +1119,7 @@ class VideoPlayer:
             self._pause_event.clear()
             self._paused = True
         else:
+            self._resync = True
             self._pause_event.set()
             self._paused = False
 
@@ -586,26 +1128,33 @@ class VideoPlayer:
         if not self._stopped:
             # # for debugging purposes
             # print(f"Duration: {self._duration / self._speed}")
-            # with self._time_lock:
-            #     print(f"pts duration: {self._time}")
+            # print(f"pts duration: {self._time}")
 
             self._stopped = True
 
             if not self._pause_event.is_set():
                 self._pause_event.set()
 
-            for i in [self._audio_thread, self._video_thread]:
+            if self._has_audio and self._play_audio:
+                self._buffer_event.set()
+
+            # wake up the demux thread and anything waiting for a packet
+            self._start_barrier.abort()
+            self._demux_event.set()
+            self._video_packets.put((self._serial, None))
+            self._audio_packets.put((self._serial, None))
+
+            for i in [self._demux_thread, self._audio_thread, self._video_thread]:
                 try:
                     i.join()
                 except Exception:
                     pass
 
             if self._has_audio and self._play_audio:
-                self._audio_container.close()
                 self._stream.abort()
                 self._stream.stop()
                 self._stream.close()
 
-            self._video_container.close()
+            self._container.close()
 
             return
@@ -1,9 +1,12 @@
 from fractions import Fraction
+import collections
+import sys
 import threading
 import time
 import queue
 
 import av
+from av.video.reformatter import VideoReformatter
 import pygame as pg
 import numpy as np
 from pygame.typing import Point
@@ -23,6 +26,7 @@ class VideoRecorder:
         channels: int = 2,
         channel_layout: str = "stereo",
         audio_codec: str = "aac",
+        hardware_encoding: bool = True,
     ) -> None:
         """
         The constructor for the VideoRecorder class
@@ -47,13 +51,19 @@ class VideoRecorder:
             - channel_layout: str. The layout of the audio channels. Defaults to `stereo`.
 
             - audio_codec: str. The name of the audio codec to use. Defaults to `aac`
+
+            - hardware_encoding: bool. Whether or not to encode the video on the GPU when `video_codec` is `libx264` and a hardware H.264 encoder is available. Falls back to `libx264` otherwise. Defaults to `True`.
         """
         self._output = output_file
 
         self._size = size
         self._fps = Fraction(frame_rate)
-        self._video_codec = video_codec
         self._pixel_format = video_format
+        self._hardware_encoding = hardware_encoding
+        self._video_codec = self._video_encoder(video_codec)
+        self._has_alpha = any(
+            i.is_alpha for i in av.VideoFormat(self._pixel_format).components
+        )
 
         self._record_audio = record_audio
         self._frequency = frequency
@@ -68,12 +78,26 @@ class VideoRecorder:
                 self._audio_codec, self._frequency
             )
             self._audio_stream.layout = self._channel_layout
-            self._audio_stream.format = "fltp"
             self._audio_stream.time_base = Fraction(1, self._frequency)
 
+            # samples are captured in a format the encoder takes as it is, so
+            # PyAV never has to convert them. int16 is half the size of float,
+            # and packed formats need no transpose either
+            codec = self._audio_stream.codec_context.codec
+            formats = [i.name for i in codec.audio_formats or []]
+            self._sample_format = next(
+                (i for i in ["s16", "flt", "s16p", "fltp"] if i in formats), "fltp"
+            )
+            self._audio_stream.format = self._sample_format
+            dtype = np.int16 if self._sample_format.startswith("s16") else np.float32
+
             self._input_stream = sd.InputStream(
-                self._frequency, channels=self._channels, dtype=np.float32
+                self._frequency, channels=self._channels, dtype=dtype
             )
+            if av.AudioFormat(self._sample_format).is_planar:
+                self._audio_buffer = np.empty((self._channels, 1024), dtype)
+            else:
+                self._audio_buffer = None
 
             self._audio_thread = None
         else:
@@ -81,16 +105,43 @@ class VideoRecorder:
             self._input_stream = None
             self._audio_thread = None
 
-        self._video_frames: queue.Queue[pg.Surface] = queue.Queue(50)
+        # keeps one swscale context for the whole recording instead of
+        # setting up a new one for every frame
+        self._reformatter = VideoReformatter()
+
+        # a full deque drops its oldest frame on append, and appending or
+        # popping needs no lock with a single writer and reader
+        self._video_frames: collections.deque[tuple[pg.Surface, int]] = (
+            collections.deque(maxlen=50)
+        )
+        self._frame_added = threading.Event()
 
         self._video_stream = self._container.add_stream(self._video_codec, self._fps)
         self._video_stream.width = self._size[0]
         self._video_stream.height = self._size[1]
         self._video_stream.pix_fmt = self._pixel_format
+        # a keyframe every second, and no lookahead or b-frames holding frames back
+        self._video_stream.codec_context.gop_size = max(1, round(self._fps))
+        self._video_stream.options = {
+            "libx264": {"preset": "ultrafast", "tune": "zerolatency"},
+            "h264_nvenc": {"preset": "p1", "tune": "ll"},
+            "h264_qsv": {"preset": "veryfast"},
+        }.get(self._video_codec, {})
+
+        # packets from both encoders are written to the file by one thread, so
+        # a slow disk never stalls encoding and the container is never muxed
+        # into from two threads at once. a few seconds of packets can queue
+        # up before the encoders wait for the disk
+        self._packets: queue.Queue[av.Packet | None] = queue.Queue(256)
+        self._mux_error: Exception | None = None
+
+        self._start_time = time.perf_counter()
+        self._last_pts = -1
 
         self._stopped = False
 
         self._frame_thread = None
+        self._mux_thread = None
 
     @property
     def output_file(self) -> str:
@@ -176,6 +227,13 @@ class VideoRecorder:
         """
         return self._record_audio
 
+    @property
+    def hardware_encoding(self) -> bool:
+        """
+        Whether or not a hardware encoder is used when available (read-only).
+        """
+        return self._hardware_encoding
+
     @property
     def stopped(self) -> bool:
         """
@@ -183,10 +241,36 @@ class VideoRecorder:
         """
         return self._stopped
 
+    def _video_encoder(self, codec: str) -> str:
+        """
+        The first hardware H.264 encoder that opens for this video, or `codec` if there is none.
+        """
+        if not self._hardware_encoding or codec != "libx264":
+            return codec
+
+        for i in ["h264_nvenc", "h264_qsv", "h264_vaapi", "h264_videotoolbox"]:
+            # most FFmpeg builds include these encoders, so they are only
+            # usable if a context actually opens on this machine
+            try:
+                context = av.CodecContext.create(i, "w")
+                context.width = self._size[0]
+                context.height = self._size[1]
+                context.pix_fmt = self._pixel_format
+                context.time_base = 1 / self._fps
+                context.open()
+            except (av.FFmpegError, ValueError):
+                continue
+
+            return i
+
+        return codec
+
     def start(self) -> None:
         """
         Start the video recorder.
         """
+        self._start_time = time.perf_counter()
+
         if self._record_audio:
             self._audio_thread = threading.Thread(
                 target=self._audio_record, daemon=True
@@ -196,69 +280,155 @@ class VideoRecorder:
         self._frame_thread = threading.Thread(target=self._write_frame, daemon=True)
         self._frame_thread.start()
 
+        self._mux_thread = threading.Thread(target=self._mux_packets, daemon=True)
+        self._mux_thread.start()
+
+    def _mux_packets(self) -> None:
+        """
+        Writes encoded packets to the file.
+        """
+        while True:
+            packet = self._packets.get()
+            if packet is None:
+                break
+
+            # after a failed write the rest of the packets are dropped, so the
+            # encoders never wait on a full queue
+            if self._mux_error:
+                continue
+
+            try:
+                self._container.mux(packet)
+            except Exception as e:
+                # the recording is stopped, and stop() raises the error
+                self._mux_error = e
+                self._stopped = True
+                self._frame_added.set()
+
     def _audio_record(self) -> None:
         """
         Gets audio and adds it to the file.
         """
-
-        # TODO: Make audio work
         self._input_stream.start()
 
         pts = 0
         while not self._stopped:
-            if not self._input_stream.stopped or self._input_stream.closed:
-                data, overflowed = self._input_stream.read(1024)
-                if overflowed:
-                    raise OverflowError("Audio input stream overflowed.")
-
-                data = np.ascontiguousarray(data.T)
-
-                frame = av.AudioFrame.from_ndarray(
-                    data, "fltp", self._audio_stream.layout
-                )
+            data, overflowed = self._input_stream.read(1024)
+            if overflowed:
+                raise OverflowError("Audio input stream overflowed.")
+
+            if self._audio_buffer is not None:
+                # the samples are copied straight into planar order, without a
+                # new contiguous array for every block
+                self._audio_buffer[...] = data.T
+                data = self._audio_buffer
+            else:
+                data = data.reshape(1, -1)
+
+            frame = av.AudioFrame.from_ndarray(
+                data, self._sample_format, self._audio_stream.layout
+            )
+            frame.sample_rate = self._frequency
 
-                frame.pts = pts
-                pts += frame.samples
+            frame.pts = pts
+            pts += frame.samples
 
-                for i in self._audio_stream.encode(frame):
-                    self._container.mux(i)
+            for i in self._audio_stream.encode(frame):
+                self._packets.put(i)
 
-            for i in self._audio_stream.encode():
-                self._container.mux(i)
+        for i in self._audio_stream.encode():
+            self._packets.put(i)
 
     def _write_frame(self) -> None:
         """
         Writes video frames to the file.
         """
-        start = time.perf_counter()
-        while not self._stopped:
-            if self._stopped:
-                break
-
+        while True:
             try:
-                surf = self._video_frames.get(timeout=0.1)
-            except queue.Empty:
+                surf, pts = self._video_frames.popleft()
+            except IndexError:
+                # frames written before stop() are still encoded
+                if self._stopped:
+                    break
+
+                self._frame_added.wait()
+                self._frame_added.clear()
                 continue
 
-            if surf.get_size() != self._size:
-                surf = pg.transform.scale(surf, self._size)
-
-            buf = pg.image.tobytes(surf, "RGBA")
+            frame = self._convert_frame(surf)
 
-            frame = av.VideoFrame.from_bytes(buf, self._size[0], self._size[1], "rgba")
-            frame = frame.reformat(format=self._pixel_format)
-
-            now = int((time.perf_counter() - start) * float(self._fps))
-            frame.pts = now
+            frame.pts = pts
             frame.time_base = Fraction(1, self._fps)
 
             for i in self._video_stream.encode(frame):
-                self._container.mux(i)
-
-            time.sleep(float(frame.time_base))
+                self._packets.put(i)
 
         for i in self._video_stream.encode():
-            self._container.mux(i)
+            self._packets.put(i)
+
+    def _surface_format(self, surface: pg.Surface) -> str | None:
+        """
+        The FFmpeg pixel format whose 24 or 32-bit pixels match the layout of `surface`, if any.
+        """
+        little = sys.byteorder == "little"
+        masks = surface.get_masks()
+
+        if surface.get_bytesize() == 3:
+            if masks == (0xFF0000, 0xFF00, 0xFF, 0):
+                return "bgr24" if little else "rgb24"
+            if masks == (0xFF, 0xFF00, 0xFF0000, 0):
+                return "rgb24" if little else "bgr24"
+
+            return None
+
+        if surface.get_bytesize() != 4:
+            return None
+
+        # the unused byte of an opaque surface would be read as transparent
+        if not masks[3] and self._has_alpha:
+            return None
+
+        if masks in [(0xFF0000, 0xFF00, 0xFF, 0), (0xFF0000, 0xFF00, 0xFF, 0xFF000000)]:
+            return "bgra" if little else "argb"
+        if masks in [(0xFF, 0xFF00, 0xFF0000, 0), (0xFF, 0xFF00, 0xFF0000, 0xFF000000)]:
+            return "rgba" if little else "abgr"
+
+        return None
+
+    def _convert_frame(self, surface: pg.Surface) -> av.VideoFrame:
+        """
+        Convert `surface` into a frame in the size and pixel format of the video.
+        """
+        width, height = surface.get_size()
+        surface_format = self._surface_format(surface)
+        if surface_format:
+            # the frame shares the surface's pixels instead of copying them, and
+            # swscale reads their own layout, so converting to the video's pixel
+            # format is the only pass over the pixels
+            depth = surface.get_bytesize()
+            pixels = np.frombuffer(surface.get_buffer(), np.uint8)
+            pixels = pixels.reshape(height, -1)[:, : width * depth]
+            frame = av.VideoFrame.from_numpy_buffer(
+                pixels.reshape(height, width, depth), surface_format
+            )
+        elif self._has_alpha:
+            buf = pg.image.tobytes(surface, "RGBA")
+            frame = av.VideoFrame.from_bytes(buf, width, height, "rgba")
+        else:
+            # without an alpha plane to fill, 3 bytes a pixel is all swscale needs
+            pixels = np.frombuffer(pg.image.tobytes(surface, "RGB"), np.uint8)
+            frame = av.VideoFrame.from_numpy_buffer(
+                pixels.reshape(height, width, 3), "rgb24"
+            )
+
+        # surfaces of another size are scaled in the same swscale pass
+        return self._reformatter.reformat(
+            frame,
+            width=self._size[0],
+            height=self._size[1],
+            format=self._pixel_format,
+            interpolation="FAST_BILINEAR",
+        )
 
     def write_frame(self, frame: pg.Surface) -> None:
         """
@@ -267,23 +437,46 @@ class VideoRecorder:
         Params:
             - frame: pg.Surface. The surface to add to to the video.
         """
-        try:
-            self._video_frames.put(frame, False)
-        except queue.Full:
-            self._video_frames.get_nowait()
-            self._video_frames.put(frame, False)
+        if self._stopped:
+            return
+
+        # frames are timed when they are drawn rather than when the encoder
+        # gets to them, and only the first one in each frame interval is kept,
+        # so the timestamps always increase
+        pts = int((time.perf_counter() - self._start_time) * self._fps)
+        if pts <= self._last_pts:
+            return
+
+        self._last_pts = pts
+
+        # the caller keeps drawing on its surface (usually the display) while
+        # the encoder reads this one
+        self._video_frames.append((frame.copy(), pts))
+        self._frame_added.set()
 
     def stop(self) -> None:
         """
-        Stop the recorder.
+        Stop the recorder. Raises the error that stopped writing the file, if any.
         """
         self._stopped = True
+        self._frame_added.set()
 
         for i in [self._frame_thread, self._audio_thread]:
             if i:
                 i.join()
 
+        if self._mux_thread:
+            self._packets.put(None)
+            self._mux_thread.join()
+
         if self._record_audio:
             self._input_stream.close()
 
-        self._container.close()
+        try:
+            self._container.close()
+        except av.FFmpegError:
+            if not self._mux_error:
+                raise
+
+        if self._mux_error:
+            raise self._mux_error